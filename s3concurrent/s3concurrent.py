@@ -1,26 +1,60 @@
 #!/usr/bin/env python
 
 import argparse
+import base64
 import binascii
+import boto.utils
+import calendar
 import colorlog
+import cProfile
+import fnmatch
 import hashlib
+import json
 import logging
 import os
+import pstats
+import re
 import sys
+import tarfile
+import tempfile
 import threading
 import time
+import zlib
 
 from boto.s3.bucket import Bucket
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
+from cStringIO import StringIO
 from Queue import Queue
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # AWS magic chunk size number. Discovered via brute force.
 AWS_UPLOAD_PART_SIZE = 64 * 1024 * 1024
 
 # Max number of items allowed in the queue to keep from blowing up memory
 MAX_QUEUE_SIZE = 100000
 
+# Size of the uncompressed chunks read from a local file while streaming it through a compressor
+COMPRESSION_CHUNK_SIZE = 1024 * 1024
+
+# zlib window bits that produce/consume the gzip container format
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Metadata used to compare a compressed S3 object against its uncompressed local file
+ORIGINAL_MD5_METADATA = 's3concurrent-original-md5'
+ORIGINAL_SIZE_METADATA = 's3concurrent-original-size'
+
+# Max number of fetched objects waiting to be written into a sink, each spooled in memory up to SINK_SPOOL_SIZE
+SINK_BUFFER_SIZE = 32
+SINK_SPOOL_SIZE = 8 * 1024 * 1024
+
+# Number of functions listed in the hotspot table logged when profiling
+PROFILE_TOP_N = 20
+
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -40,9 +74,15 @@ class ProcessKeyQueue:
     def __init__(self):
         self.process_able_keys_queue = Queue()
         self.enqueued_counter = 0
+        self.first_enqueued_counter = 0
         self.de_queue_counter = 0
+        self.transferred_counter = 0
+        self.skipped_counter = 0
+        self.failed_counter = 0
+        self.outcome_lock = threading.Lock()
         self.all_processed = False
         self.queuing = False
+        self.enqueue_failed = False
 
     def enqueue_item(self, key, local_file_path, enqueue_count=1):
         '''
@@ -54,6 +94,8 @@ class ProcessKeyQueue:
         '''
         self.process_able_keys_queue.put((key, local_file_path, enqueue_count))
         self.enqueued_counter += 1
+        if enqueue_count == 1:
+            self.first_enqueued_counter += 1
 
     def is_empty(self):
         '''
@@ -97,8 +139,273 @@ class ProcessKeyQueue:
         '''
         self.queuing = True
 
+    def key_transferred(self):
+        '''
+        Counts a key that has been uploaded/downloaded.
+        '''
+        with self.outcome_lock:
+            self.transferred_counter += 1
+
+    def key_skipped(self):
+        '''
+        Counts a key that did not need to be uploaded/downloaded.
+        '''
+        with self.outcome_lock:
+            self.skipped_counter += 1
+
+    def key_failed(self):
+        '''
+        Counts a key that could not be uploaded/downloaded.
+        '''
+        with self.outcome_lock:
+            self.failed_counter += 1
+
+
+class TarSink:
+    '''
+    TarSink writes downloaded objects into a single streaming tar archive instead of local files.
+
+    Objects fetched concurrently are handed over through a bounded buffer and written sequentially,
+    in the order their downloads complete, by a dedicated writer thread.
+    '''
+
+    def __init__(self, target, buffer_size=SINK_BUFFER_SIZE):
+        '''
+        :param target:              path to the tar archive to write, or "-" for stdout
+        :param buffer_size:         max number of fetched objects waiting to be written
+        '''
+        self.target = target
+        self.fileobj = sys.stdout if target == '-' else open(target, 'wb')
+        self.tar = tarfile.open(fileobj=self.fileobj, mode='w|')
+        self.pending_entries = Queue(maxsize=buffer_size)
+        self.written_counter = 0
+        self.failed = False
+
+        self.writer_thread = threading.Thread(target=self._write_entries)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def add(self, name, fileobj, size, mtime):
+        '''
+        Hands a fetched object over to the writer thread, blocking while the buffer is full.
+
+        :param name:                member name in the archive
+        :param fileobj:             file object positioned at the start of the content, closed once written
+        :param size:                (int) content size in bytes
+        :param mtime:               (int) modification time as a unix timestamp
+        '''
+        self.pending_entries.put((name, fileobj, size, mtime))
+
+    def _write_entries(self):
+        '''
+        Writes buffered entries into the archive until close() is called.
+        '''
+        while True:
+            entry = self.pending_entries.get()
+            if entry is None:
+                break
+
+            name, fileobj, size, mtime = entry
+            try:
+                try:
+                    if not self.failed:
+                        # encode unicode names explicitly, tarfile would use the locale's encoding
+                        info = tarfile.TarInfo(name.encode('utf-8') if isinstance(name, unicode) else name)
+                        info.size = size
+                        info.mtime = mtime
+                        self.tar.addfile(info, fileobj)
+                        self.written_counter += 1
+
+                finally:
+                    fileobj.close()
+
+            except:
+                # keep draining the buffer so downloading threads never block on a dead writer
+                self.failed = True
+                logger.exception('Cannot write %s into %s', name, self.target)
+
+    def close(self):
+        '''
+        Waits for all buffered entries to be written and finalizes the archive.
+        Check failed afterwards, the archive is incomplete if any entry could not be written.
+        '''
+        self.pending_entries.put(None)
+        self.writer_thread.join()
+
+        try:
+            self.tar.close()
+            if self.fileobj is sys.stdout:
+                self.fileobj.flush()
+            else:
+                self.fileobj.close()
+
+        except:
+            self.failed = True
+            logger.exception('Cannot finalize %s', self.target)
+
+
+class ThreadProfiler:
+    '''
+    ThreadProfiler profiles the lister, consumer and worker threads, which cProfile alone cannot see
+    from the main thread, and merges their statistics into a single pstats file.
+    '''
+
+    def __init__(self, output_path, top_n=PROFILE_TOP_N):
+        '''
+        :param output_path:         path to write the merged pstats file to
+        :param top_n:               number of functions listed in the hotspot table
+        '''
+        self.output_path = output_path
+        self.top_n = top_n
+        self.stats = None
+        self.stats_lock = threading.Lock()
+
+    def wrap(self, target):
+        '''
+        Wraps a thread target so that it runs under its own profiler.
+
+        :param target:              the function to be run in a thread
+        :return:                    the profiled function
+        '''
+        def profiled_target(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(target, *args, **kwargs)
+            finally:
+                self._merge(profile)
+
+        return profiled_target
+
+    def _merge(self, profile):
+        '''
+        Merges the statistics of a finished thread right away to keep memory flat.
+
+        :param profile:             a cProfile.Profile instance
+        '''
+        with self.stats_lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile, stream=StringIO())
+            else:
+                self.stats.add(profile)
+
+    def report(self):
+        '''
+        Writes the merged statistics to output_path and logs the top hotspots by own time.
+        '''
+        with self.stats_lock:
+            if self.stats is None:
+                logger.info('No profiling data collected')
+                return
+
+            self.stats.dump_stats(self.output_path)
+
+            self.stats.stream = StringIO()
+            self.stats.sort_stats('tottime').print_stats(self.top_n)
+            logger.info('Profile written to {0}. Top {1} hotspots:\n{2}'.format(
+                self.output_path, self.top_n, self.stats.stream.getvalue()))
+
+
+class KeyFilter:
+    '''
+    KeyFilter decides which keys are processed, combining include/exclude glob patterns with a
+    deterministic shard assignment so that several hosts can split a prefix without coordinating.
+    '''
+
+    def __init__(self, shard_index=0, shard_count=1, includes=None, excludes=None):
+        '''
+        :param shard_index:         index of the shard processed by this host, 0 <= shard_index < shard_count
+        :param shard_count:         total number of shards
+        :param includes:            glob patterns, relative to the prefix/folder, a key must match one of
+        :param excludes:            glob patterns, relative to the prefix/folder, a key must match none of
+        '''
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.includes = includes or []
+        self.excludes = excludes or []
+        self.include_regex = self._compile(self.includes)
+        self.exclude_regex = self._compile(self.excludes)
+        self.rejected_counter = 0
+
+    @staticmethod
+    def _compile(patterns):
+        '''
+        Compiles glob patterns into a single regular expression.
+
+        :param patterns:            a list of glob patterns
+        :return:                    a compiled regular expression, or None if there are no patterns
+        '''
+        if not patterns:
+            return None
+
+        return re.compile('|'.join('(?:{0})'.format(fnmatch.translate(pattern)) for pattern in patterns))
+
+    def accepts(self, key_name, relative_name):
+        '''
+        Checks if a key should be processed.
+
+        :param key_name:            (str), the full S3 key name, used to pick the shard
+        :param relative_name:       (str), the key name relative to the prefix, matched against the patterns
+        :return:                    (bool) True if the key should be processed
+        '''
+        accepted = (
+            (self.include_regex is None or self.include_regex.match(relative_name)) and
+            (self.exclude_regex is None or not self.exclude_regex.match(relative_name)) and
+            (self.shard_count == 1 or get_shard(key_name, self.shard_count) == self.shard_index)
+        )
+
+        if not accepted:
+            self.rejected_counter += 1
+
+        return bool(accepted)
+
+
+def get_shard(key_name, shard_count):
+    '''
+    Deterministically assigns a key to a shard, identically on every host.
+
+    :param key_name:                (str), the full S3 key name
+    :param shard_count:             (int), total number of shards
+    :return:                        (int), the shard index of the key
+    '''
+    if isinstance(key_name, unicode):
+        key_name = key_name.encode('utf-8')
+
+    return int(hashlib.md5(key_name).hexdigest()[:16], 16) % shard_count
+
+
+def parse_shard(shard_spec):
+    '''
+    Parses a shard specification.
+
+    :param shard_spec:              (str), "i/N" where 0 <= i < N
+    :return:                        a (shard index, shard count) tuple
+    '''
+    try:
+        shard_index, shard_count = [int(part) for part in shard_spec.split('/')]
+    except ValueError:
+        raise ValueError('Invalid shard: {0}. Expected i/N'.format(shard_spec))
+
+    if not 0 <= shard_index < shard_count:
+        raise ValueError('Invalid shard: {0}. Expected 0 <= i < N'.format(shard_spec))
+
+    return shard_index, shard_count
+
+
+def open_sink(sink_spec):
+    '''
+    Opens a download sink from its command line specification.
+
+    :param sink_spec:               (str), "tar:-" to stream a tar archive to stdout, or "tar:<path>"
+    :return:                        a TarSink instance
+    '''
+    sink_type, _, target = sink_spec.partition(':')
+    if sink_type != 'tar' or not target:
+        raise ValueError('Unsupported sink: {0}. Expected tar:- or tar:<path>'.format(sink_spec))
+
+    return TarSink(target)
+
 
-def enqueue_s3_keys_for_download(s3_bucket, prefix, destination_folder, queue):
+def enqueue_s3_keys_for_download(s3_bucket, prefix, destination_folder, queue, sink=None, key_filter=None):
     '''
     En-queues S3 Keys to be downloaded.
 
@@ -106,32 +413,109 @@ def enqueue_s3_keys_for_download(s3_bucket, prefix, destination_folder, queue):
     :param prefix:                  The path to the S3 folder to be downloaded. Example: bucket_root/folder_1
     :param destination_folder:      The relative or absolute path to the folder you wish to download to
     :param queue:                   A ProcessKeyQueue instance to enqueue all the keys in
+    :param sink:                    A TarSink instance to download into instead of destination_folder
+    :param key_filter:              A KeyFilter instance selecting the keys to enqueue
     '''
-    bucket_list = s3_bucket.list(prefix=prefix)
+    try:
+        bucket_list = s3_bucket.list(prefix=prefix)
+
+        for key in bucket_list:
+            _enqueue_key_for_download(key, prefix, destination_folder, queue, sink, key_filter)
+
+        logger.info('Initial queuing has completed. {0} keys has been enqueued.'.format(queue.enqueued_counter))
+
+    except:
+        # let the run report itself as interrupted rather than complete
+        queue.enqueue_failed = True
+        logger.exception('Queuing has been interrupted after {0} keys'.format(queue.enqueued_counter))
+        raise
+
+    finally:
+        queue.queuing_stopped()
+
+
+def enqueue_listed_keys_for_download(s3_bucket, prefix, destination_folder, queue, listed_keys, sink=None,
+                                     key_filter=None):
+    '''
+    En-queues S3 Keys to be downloaded from an explicit key list instead of listing the bucket.
+
+    :param s3_bucket:               Boto Bucket object that contains the keys to be downloaded
+    :param prefix:                  The path to the S3 folder to be downloaded. Example: bucket_root/folder_1
+    :param destination_folder:      The relative or absolute path to the folder you wish to download to
+    :param queue:                   A ProcessKeyQueue instance to enqueue all the keys in
+    :param listed_keys:             An iterable of (key name, size, etag) tuples, see read_key_list. Keys outside of
+                                    prefix are skipped.
+    :param sink:                    A TarSink instance to download into instead of destination_folder
+    :param key_filter:              A KeyFilter instance selecting the keys to enqueue
+    '''
+    try:
+        for key_name, size, etag in listed_keys:
+            if prefix and not key_name.startswith(prefix):
+                logger.warn('Ignoring %s since it is outside of %s', key_name, prefix)
+                continue
+
+            key = Key(s3_bucket)
+            key.key = key_name
+            if size is not None:
+                key.size = size
+            if etag is not None:
+                key.etag = etag
+
+            _enqueue_key_for_download(key, prefix, destination_folder, queue, sink, key_filter)
+
+        logger.info('Initial queuing has completed. {0} keys has been enqueued.'.format(queue.enqueued_counter))
+
+    except:
+        # let the run report itself as interrupted rather than complete
+        queue.enqueue_failed = True
+        logger.exception('Queuing has been interrupted after {0} keys'.format(queue.enqueued_counter))
+        raise
+
+    finally:
+        queue.queuing_stopped()
+
+
+def _enqueue_key_for_download(key, prefix, destination_folder, queue, sink=None, key_filter=None):
+    '''
+    Prepares the local folder structure for a S3 key and en-queues it to be downloaded.
+
+    :param key:                     Boto Key object to be downloaded
+    :param prefix:                  The path to the S3 folder to be downloaded. Example: bucket_root/folder_1
+    :param destination_folder:      The relative or absolute path to the folder you wish to download to
+    :param queue:                   A ProcessKeyQueue instance to enqueue the key in
+    :param sink:                    A TarSink instance to download into instead of destination_folder
+    :param key_filter:              A KeyFilter instance selecting the keys to enqueue
+    '''
+    relative_name = (key.name.replace(prefix, '', 1) if prefix else key.name).lstrip('/')
+    if key_filter is not None and not key_filter.accepts(key.name, relative_name):
+        return
+
+    try:
+        if sink is not None:
+            # the destination is the member name in the archive, no local structure needed
+            destination = relative_name
+
+        else:
+            # prepare local destination structure
+            destination = destination_folder + key.name.replace(prefix, '', 1) if prefix else ('/' + key.name)
+            if prefix and not _is_within_folder(destination, destination_folder):
+                logger.warn('Ignoring %s since it would be downloaded outside of %s', key.name, destination_folder)
+                return
 
-    for key in bucket_list:
-        # prepare local destination structure
-        destination = destination_folder + key.name.replace(prefix, '', 1) if prefix else ('/' + key.name)
-        try:
             containing_dir = os.path.dirname(destination)
             if not os.path.exists(containing_dir):
                 os.makedirs(containing_dir)
 
-            # Don't queue more items while over 100,000 to prevent memory explosion
-            while MAX_QUEUE_SIZE < queue.process_able_keys_queue.qsize():
-                time.sleep(1)
+        _wait_for_queue_capacity(queue)
 
-            # enqueue
-            queue.enqueue_item(key, destination)
+        # enqueue
+        queue.enqueue_item(key, destination)
 
-        except:
-            logger.exception('Cannot enqueue key: {0}'.format(key.name))
+    except:
+        logger.exception('Cannot enqueue key: {0}'.format(key.name))
 
-    logger.info('Initial queuing has completed. {0} keys has been enqueued.'.format(queue.enqueued_counter))
-    queue.queuing_stopped()
 
-
-def enqueue_s3_keys_for_upload(s3_bucket, prefix, from_folder, queue):
+def enqueue_s3_keys_for_upload(s3_bucket, prefix, from_folder, queue, key_filter=None):
     '''
     En-queues S3 Keys to be uploaded.
 
@@ -139,47 +523,189 @@ def enqueue_s3_keys_for_upload(s3_bucket, prefix, from_folder, queue):
     :param prefix:                  The path to the S3 folder to be downloaded. Example: bucket_root/folder_1
     :param from_folder:             The relative or absolute path to the folder you wish to upload from
     :param queue:                   A ProcessKeyQueue instance to enqueue all the keys in
+    :param key_filter:              A KeyFilter instance selecting the keys to enqueue
     '''
     abs_from_folder_path = os.path.abspath(from_folder)
 
-    for root, dirs, files in os.walk(abs_from_folder_path):
-        for single_file in files:
-            abs_file_path = os.path.join(root, single_file)
+    try:
+        for root, dirs, files in os.walk(abs_from_folder_path):
+            for single_file in files:
+                abs_file_path = os.path.join(root, single_file)
+                _enqueue_file_for_upload(s3_bucket, prefix, abs_from_folder_path, abs_file_path, queue, key_filter)
 
-            s3_key_name = abs_file_path.replace(abs_from_folder_path, '', 1)
-            if not s3_key_name.startswith('/') and prefix != '':
-                s3_key_name = '/' + s3_key_name
-            s3_key_name = prefix + s3_key_name
+        logger.info('Initial queuing has completed. {0} keys has been enqueued.'.format(queue.enqueued_counter))
 
-            key = Key(s3_bucket)
-            key.key = s3_key_name
+    except:
+        # let the run report itself as interrupted rather than complete
+        queue.enqueue_failed = True
+        logger.exception('Queuing has been interrupted after {0} keys'.format(queue.enqueued_counter))
+        raise
+
+    finally:
+        queue.queuing_stopped()
 
-            # Don't queue more items to prevent memory explosion
-            while MAX_QUEUE_SIZE < queue.process_able_keys_queue.qsize():
-                time.sleep(1)
 
-            queue.enqueue_item(key, abs_file_path)
+def enqueue_listed_files_for_upload(s3_bucket, prefix, from_folder, queue, listed_files, key_filter=None):
+    '''
+    En-queues S3 Keys to be uploaded from an explicit file list instead of walking the local folder.
+
+    :param s3_bucket:               Boto Bucket object that contains the keys to be uploaded to
+    :param prefix:                  The path to the S3 folder to be downloaded. Example: bucket_root/folder_1
+    :param from_folder:             The relative or absolute path to the folder you wish to upload from
+    :param queue:                   A ProcessKeyQueue instance to enqueue all the keys in
+    :param listed_files:            An iterable of (file path, size, etag) tuples, see read_key_list. File paths
+                                    are relative to from_folder unless absolute, and must be located within it.
+                                    Missing files, e.g. deletions in a change list, are skipped.
+    :param key_filter:              A KeyFilter instance selecting the keys to enqueue
+    '''
+    abs_from_folder_path = os.path.abspath(from_folder)
 
-    logger.info('Initial queuing has completed. {0} keys has been enqueued.'.format(queue.enqueued_counter))
-    queue.queuing_stopped()
+    try:
+        for file_path, size, etag in listed_files:
+            abs_file_path = os.path.abspath(os.path.join(abs_from_folder_path, file_path))
+
+            if not _is_within_folder(abs_file_path, abs_from_folder_path):
+                logger.warn('Ignoring %s since it is outside of %s', file_path, abs_from_folder_path)
+
+            elif not os.path.isfile(abs_file_path):
+                logger.warn('Ignoring %s since it is not an existing file', file_path)
+
+            else:
+                _enqueue_file_for_upload(s3_bucket, prefix, abs_from_folder_path, abs_file_path, queue, key_filter)
+
+        logger.info('Initial queuing has completed. {0} keys has been enqueued.'.format(queue.enqueued_counter))
+
+    except:
+        # let the run report itself as interrupted rather than complete
+        queue.enqueue_failed = True
+        logger.exception('Queuing has been interrupted after {0} keys'.format(queue.enqueued_counter))
+        raise
+
+    finally:
+        queue.queuing_stopped()
+
+
+def _enqueue_file_for_upload(s3_bucket, prefix, abs_from_folder_path, abs_file_path, queue, key_filter=None):
+    '''
+    Builds the S3 key for a local file and en-queues it to be uploaded.
 
+    :param s3_bucket:               Boto Bucket object that contains the keys to be uploaded to
+    :param prefix:                  The path to the S3 folder to be downloaded. Example: bucket_root/folder_1
+    :param abs_from_folder_path:    The absolute path to the folder you wish to upload from
+    :param abs_file_path:           The absolute path to the file to be uploaded
+    :param queue:                   A ProcessKeyQueue instance to enqueue the key in
+    :param key_filter:              A KeyFilter instance selecting the keys to enqueue
+    '''
+    s3_key_name = abs_file_path.replace(abs_from_folder_path, '', 1)
+    relative_name = s3_key_name.lstrip('/')
+    if not s3_key_name.startswith('/') and prefix != '':
+        s3_key_name = '/' + s3_key_name
+    s3_key_name = prefix + s3_key_name
+
+    if key_filter is not None and not key_filter.accepts(s3_key_name, relative_name):
+        return
+
+    key = Key(s3_bucket)
+    key.key = s3_key_name
+
+    _wait_for_queue_capacity(queue)
+
+    queue.enqueue_item(key, abs_file_path)
+
+
+def _is_within_folder(path, folder):
+    '''
+    Checks if a path resolves to a location within a folder.
+
+    :param path:                    (str), the path to check
+    :param folder:                  (str), the folder the path should be located in
+    :return:                        (bool) True if the path is within the folder
+    '''
+    return os.path.abspath(path).startswith(os.path.join(os.path.abspath(folder), ''))
+
+
+def _wait_for_queue_capacity(queue):
+    '''
+    Blocks while the queue holds more than MAX_QUEUE_SIZE items to prevent memory explosion.
+
+    :param queue:                   A ProcessKeyQueue instance
+    '''
+    while MAX_QUEUE_SIZE < queue.process_able_keys_queue.qsize():
+        time.sleep(1)
+
+
+def open_key_list(list_path):
+    '''
+    Opens a key/file list.
 
-def is_sync_needed(key, local_file_path):
+    :param list_path:               (str), path to the list file, or "-" for stdin
+    :return:                        a file object to be passed to read_key_list
+    '''
+    return sys.stdin if list_path == '-' else open(list_path, 'r')
+
+
+def read_key_list(list_file):
+    '''
+    Lazily reads S3 key names or local file paths from a list file, one entry per line.
+
+    A line is either a plain key name / file path, or a JSON object such as
+    {"key": "a/b/c", "size": 1024, "etag": "<etag as reported by S3>"} where size and etag are optional.
+    Blank lines are skipped, and malformed JSON lines are logged and skipped.
+
+    :param list_file:               an open list file, see open_key_list
+    :return:                        a generator of (name, size, etag) tuples, size and etag may be None
+    '''
+    for line in list_file:
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            continue
+
+        if line.lstrip().startswith('{'):
+            try:
+                entry = json.loads(line)
+                name = entry['key']
+            except (ValueError, KeyError):
+                logger.error('Cannot parse list entry: %s', line)
+                continue
+
+            yield name, entry.get('size'), entry.get('etag')
+        else:
+            yield line, None, None
+
+
+def is_sync_needed(key, local_file_path, compression=None):
     '''
     Checks if the local file is identical to the S3 key by using the file's md5 hash.
 
     :param key:                         The S3 key object.
     :param local_file_path:             (str), path to download the key to
+    :param compression:                 (str), "gzip" or "zstd" when compressed transfers are enabled
     '''
     sync_needed = True
-    if os.path.isfile(local_file_path) and key.exists():
+    remote_key = None
+
+    if os.path.isfile(local_file_path):
+        if compression:
+            # a single HEAD both checks the existence and retrieves the metadata
+            remote_key = key.bucket.get_key(key.name)
+        elif key.exists():
+            remote_key = key
+
+    if remote_key is not None:
         try:
-            key_etag = key.etag
-            if not key_etag:
-                key_etag = key.bucket.lookup(key.name).etag
+            original_md5 = remote_key.get_metadata(ORIGINAL_MD5_METADATA) if compression else None
+
+            if original_md5:
+                # compressed objects carry the checksum of the uncompressed file in their metadata
+                sync_needed = original_md5 != _get_md5(local_file_path)
 
-            if not _s3_etag_match(key_etag, local_file_path):
-                sync_needed = False
+            else:
+                key_etag = remote_key.etag
+                if not key_etag:
+                    key_etag = key.bucket.lookup(key.name).etag
+
+                if not _s3_etag_match(key_etag, local_file_path):
+                    sync_needed = False
 
         except:
             logger.exception(sys.exc_info())
@@ -219,21 +745,44 @@ def _calculate_s3_etag(file_path, part_size):
     :param part_size:                   (int), the size of the chunks that were used to upload the file to S3.
     :return:                            (str), the calculated S3 etag of the local file.
     '''
-    block_count = 0
-    md5string = ''
+    return _combine_part_md5s(_calculate_part_md5s(file_path, part_size))
+
+
+def _calculate_part_md5s(file_path, part_size, file_hasher=None):
+    '''
+    Calculates the MD5 checksum of each part of a file as it would be uploaded in parts.
+
+    :param file_path:                   (str), the local file calculate the checksums for.
+    :param part_size:                   (int), the size of the chunks used to upload the file to S3.
+    :param file_hasher:                 an optional hashlib object also fed with the whole file in the same pass.
+    :return:                            (list), the hex MD5 checksum of each part.
+    '''
+    part_md5s = []
     with open(file_path, 'rb') as open_file:
         buf = open_file.read(part_size)
         while len(buf) > 0:
             hasher = hashlib.md5()
             hasher.update(buf)
-            md5string += binascii.unhexlify(hasher.hexdigest())
-            block_count += 1
+            part_md5s.append(hasher.hexdigest())
+
+            if file_hasher is not None:
+                file_hasher.update(buf)
 
             buf = open_file.read(part_size)
 
+    return part_md5s
+
+
+def _combine_part_md5s(part_md5s):
+    '''
+    Combines the MD5 checksums of the parts of a multipart upload into its S3 etag.
+
+    :param part_md5s:                   (list), the hex MD5 checksum of each part.
+    :return:                            (str), the S3 etag of the multipart upload.
+    '''
     hasher = hashlib.md5()
-    hasher.update(md5string)
-    return hasher.hexdigest() + '-' + str(block_count)
+    hasher.update(''.join(binascii.unhexlify(part_md5) for part_md5 in part_md5s))
+    return hasher.hexdigest() + '-' + str(len(part_md5s))
 
 
 def _get_md5(filename, blocksize=65536):
@@ -254,20 +803,335 @@ def _get_md5(filename, blocksize=65536):
         return hasher.hexdigest()
 
 
-def process_a_key(queue, action, max_retry):
+def _make_compressor(compression):
+    '''
+    Creates a streaming compressor.
+
+    :param compression:                 (str), "gzip" or "zstd"
+    :return:                            an object with compress(data) and flush() methods
+    '''
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compressobj()
+
+    return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, GZIP_WBITS)
+
+
+def _make_decompressor(content_encoding):
+    '''
+    Creates a streaming decompressor for a Content-Encoding.
+
+    :param content_encoding:            (str), the Content-Encoding of a S3 object
+    :return:                            an object with a decompress(data) method, or None if not compressed
+    '''
+    if content_encoding == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    elif content_encoding == 'gzip':
+        return zlib.decompressobj(GZIP_WBITS)
+
+    return None
+
+
+def _upload_compressed(key, local_file_path, compression):
+    '''
+    Uploads a local file to S3 while compressing it on the fly. The compressed stream is sent in
+    AWS_UPLOAD_PART_SIZE multipart chunks so that no more than one part is held in memory.
+
+    :param key:                         The S3 key object to upload to.
+    :param local_file_path:             (str), the local file to upload.
+    :param compression:                 (str), "gzip" or "zstd"
+    '''
+    headers = {'Content-Encoding': compression}
+    metadata = {
+        ORIGINAL_MD5_METADATA: _get_md5(local_file_path),
+        ORIGINAL_SIZE_METADATA: str(os.path.getsize(local_file_path)),
+    }
+
+    compressor = _make_compressor(compression)
+    multipart_upload = None
+    part_num = 0
+    pieces = []
+    pending_size = 0
+
+    try:
+        with open(local_file_path, 'rb') as open_file:
+            buf = open_file.read(COMPRESSION_CHUNK_SIZE)
+            while len(buf) > 0:
+                compressed = compressor.compress(buf)
+                pieces.append(compressed)
+                pending_size += len(compressed)
+
+                if pending_size >= AWS_UPLOAD_PART_SIZE:
+                    if multipart_upload is None:
+                        multipart_upload = key.bucket.initiate_multipart_upload(
+                            key.name, headers=headers, metadata=metadata)
+
+                    part_num += 1
+                    multipart_upload.upload_part_from_file(StringIO(''.join(pieces)), part_num)
+                    pieces = []
+                    pending_size = 0
+
+                buf = open_file.read(COMPRESSION_CHUNK_SIZE)
+
+        pieces.append(compressor.flush())
+
+        if multipart_upload is None:
+            # the whole compressed file fits in a single part
+            key.update_metadata(metadata)
+            key.set_contents_from_string(''.join(pieces), headers=headers)
+
+        else:
+            part_num += 1
+            multipart_upload.upload_part_from_file(StringIO(''.join(pieces)), part_num)
+            multipart_upload.complete_upload()
+
+    except:
+        if multipart_upload is not None:
+            multipart_upload.cancel_upload()
+        raise
+
+
+def _upload_delta(key, local_file_path, delta_folder):
+    '''
+    Uploads a large local file in AWS_UPLOAD_PART_SIZE parts, copying the parts that did not change since
+    the previous upload server-side with UploadPartCopy and only sending the changed ones.
+
+    The part checksums are calculated in a single pass over the file and also decide whether the file
+    changed at all, so is_sync_needed is not used in delta mode.
+
+    :param key:                         The S3 key object to upload to.
+    :param local_file_path:             (str), the local file to upload.
+    :param delta_folder:                (str), the local folder keeping the part checksums of uploaded objects.
+    :return:                            (bool), False if the S3 object was already identical to the local file.
+    '''
+    file_size = os.path.getsize(local_file_path)
+    file_hasher = hashlib.md5()
+    part_md5s = _calculate_part_md5s(local_file_path, AWS_UPLOAD_PART_SIZE, file_hasher)
+    file_md5 = file_hasher.hexdigest()
+
+    remote_key = key.bucket.get_key(key.name)
+    remote_etag = remote_key.etag.strip('"') if remote_key is not None and remote_key.etag else None
+
+    # the object may have been uploaded in parts, or in a single request e.g. without delta mode
+    if remote_etag in (_combine_part_md5s(part_md5s), file_md5):
+        if file_size > AWS_UPLOAD_PART_SIZE and not os.path.isfile(_get_part_manifest_path(key, delta_folder)):
+            # remember the parts so the next change does not need a full upload
+            _save_part_manifest(key, delta_folder, part_md5s, file_md5)
+        return False
+
+    if file_size <= AWS_UPLOAD_PART_SIZE:
+        # a single part has nothing to be copied
+        key.set_contents_from_filename(local_file_path)
+        return True
+
+    previous_part_md5s = _load_part_manifest(key, delta_folder, remote_etag)
+
+    # fail the copies, and retry the whole upload, if the object is overwritten in the meantime
+    copy_headers = {'x-amz-copy-source-if-match': '"{0}"'.format(remote_etag)}
+
+    multipart_upload = key.bucket.initiate_multipart_upload(key.name)
+    copied_parts = 0
+
+    try:
+        with open(local_file_path, 'rb') as open_file:
+            for part_index, part_md5 in enumerate(part_md5s):
+                start = part_index * AWS_UPLOAD_PART_SIZE
+                size = min(AWS_UPLOAD_PART_SIZE, file_size - start)
+
+                if part_index < len(previous_part_md5s) and previous_part_md5s[part_index] == part_md5:
+                    multipart_upload.copy_part_from_key(
+                        key.bucket.name, key.name, part_index + 1, start, start + size - 1, headers=copy_headers)
+                    copied_parts += 1
+
+                else:
+                    open_file.seek(start)
+                    multipart_upload.upload_part_from_file(
+                        open_file, part_index + 1,
+                        md5=(part_md5, base64.b64encode(binascii.unhexlify(part_md5))), size=size)
+
+        multipart_upload.complete_upload()
+
+    except:
+        multipart_upload.cancel_upload()
+        raise
+
+    _save_part_manifest(key, delta_folder, part_md5s, file_md5)
+    logger.info('%s: copied %s unchanged parts and uploaded %s changed parts',
+                key.name, copied_parts, len(part_md5s) - copied_parts)
+
+    return True
+
+
+def _get_part_manifest_path(key, delta_folder):
+    '''
+    Builds the path of the file keeping the part checksums of a S3 key.
+
+    :param key:                         The S3 key object.
+    :param delta_folder:                (str), the local folder keeping the part checksums of uploaded objects.
+    :return:                            (str), the path of the part checksums file.
+    '''
+    key_id = u'{0}/{1}'.format(key.bucket.name, key.name).encode('utf-8')
+    return os.path.join(delta_folder, hashlib.md5(key_id).hexdigest() + '.json')
+
+
+def _load_part_manifest(key, delta_folder, remote_etag):
+    '''
+    Loads the part checksums of the previous upload of a S3 key. The checksums are only trusted when they
+    match the etag of the current S3 object, so objects changed by anyone else are fully re-uploaded.
+
+    :param key:                         The S3 key object.
+    :param delta_folder:                (str), the local folder keeping the part checksums of uploaded objects.
+    :param remote_etag:                 (str), the unquoted etag of the current S3 object, None if it does not exist.
+    :return:                            (list), the hex MD5 checksum of each part, or empty if unknown.
+    '''
+    manifest_path = _get_part_manifest_path(key, delta_folder)
+    if remote_etag is None or not os.path.isfile(manifest_path):
+        return []
+
+    try:
+        with open(manifest_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+
+        if (manifest['part_size'] == AWS_UPLOAD_PART_SIZE and
+                remote_etag in (_combine_part_md5s(manifest['parts']), manifest.get('md5'))):
+            return manifest['parts']
+
+    except:
+        logger.exception('Cannot load the part checksums of %s', key.name)
+
+    return []
+
+
+def _save_part_manifest(key, delta_folder, part_md5s, file_md5):
+    '''
+    Saves the part checksums of an uploaded S3 key.
+
+    :param key:                         The S3 key object.
+    :param delta_folder:                (str), the existing local folder keeping the part checksums of uploaded objects.
+    :param part_md5s:                   (list), the hex MD5 checksum of each part.
+    :param file_md5:                    (str), the hex MD5 checksum of the whole file.
+    '''
+    manifest_path = _get_part_manifest_path(key, delta_folder)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump({'key': key.name, 'part_size': AWS_UPLOAD_PART_SIZE, 'parts': part_md5s, 'md5': file_md5},
+                  manifest_file)
+
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+
+def _download_decompressed(key, local_file_path):
+    '''
+    Downloads a S3 object to a local file, decompressing it on the fly according to its Content-Encoding.
+
+    :param key:                         The S3 key object to download.
+    :param local_file_path:             (str), the local file to download to.
+    '''
+    try:
+        with open(local_file_path, 'wb') as open_file:
+            _write_decompressed(key, open_file)
+
+    except:
+        if os.path.isfile(local_file_path):
+            os.remove(local_file_path)
+        raise
+
+
+def _write_decompressed(key, open_file):
+    '''
+    Streams a S3 object into a file object, decompressing it on the fly according to its Content-Encoding.
+
+    :param key:                         The S3 key object to download.
+    :param open_file:                   A file object opened for writing.
+    '''
+    key.open_read()
+    decompressor = _make_decompressor(key.content_encoding)
+
+    try:
+        for buf in key:
+            open_file.write(decompressor.decompress(buf) if decompressor else buf)
+
+        if decompressor and hasattr(decompressor, 'flush'):
+            open_file.write(decompressor.flush())
+
+    except:
+        key.close(fast=True)
+        raise
+
+
+def _download_to_sink(key, member_name, sink, compression=None):
+    '''
+    Downloads a S3 object into a spooled temporary file and hands it over to a sink.
+
+    :param key:                         The S3 key object to download.
+    :param member_name:                 (str), the name of the object within the sink.
+    :param sink:                        A TarSink instance.
+    :param compression:                 (str), "gzip" or "zstd" when compressed transfers are enabled
+    '''
+    if not member_name or member_name.endswith('/'):
+        # folder placeholder keys have no content worth archiving
+        return
+
+    spool = tempfile.SpooledTemporaryFile(max_size=SINK_SPOOL_SIZE)
+    try:
+        if compression:
+            _write_decompressed(key, spool)
+        else:
+            key.get_contents_to_file(spool)
+
+        size = spool.tell()
+        spool.seek(0)
+
+    except:
+        spool.close()
+        raise
+
+    sink.add(member_name, spool, size, _get_mtime(key))
+
+
+def _get_mtime(key):
+    '''
+    Retrieves the modification time of a S3 key.
+
+    :param key:                         The S3 key object.
+    :return:                            (int), the last modified time as a unix timestamp, or now if unknown.
+    '''
+    if key.last_modified:
+        try:
+            return calendar.timegm(boto.utils.parse_ts(key.last_modified).timetuple())
+        except ValueError:
+            pass
+
+    return int(time.time())
+
+
+def process_a_key(queue, action, max_retry, compression=None, sink=None, delta_folder=None):
     '''
     Process (download or upload) a S3 key from/to respective local path.
 
     :param queue:                   A ProcessKeyQueue instance to de-queue a key from
     :param action:                  download or upload
     :param max_retry:               The max times for s3concurrent to retry uploading/downloading a key
+    :param compression:             "gzip" or "zstd" to compress uploads and decompress downloads on the fly
+    :param sink:                    A TarSink instance to download into instead of local files
+    :param delta_folder:            A local folder keeping part checksums to only upload the changed parts of large files
     '''
     if not queue.is_empty():
         key, local_path, enqueue_count = queue.de_queue_an_item()
 
+        if sink is not None and sink.failed:
+            # the archive can no longer be written, fetching the object would only throw it away
+            queue.key_failed()
+            return
+
         try:
 
-            if is_sync_needed(key, local_path) and enqueue_count <= max_retry:
+            if enqueue_count > max_retry:
+                logger.error('Ignoring {0} since s3concurrent had tried downloading {1} times.'.format(key.name, max_retry))
+                queue.key_failed()
+
+            # delta uploads compare the part checksums themselves, sparing a second pass over large files
+            elif sink is not None or (action == 'upload' and delta_folder) or is_sync_needed(key, local_path, compression):
+                transferred = True
 
                 # wait accordingly to enqueue_count
                 if enqueue_count > 1:
@@ -277,16 +1141,32 @@ def process_a_key(queue, action, max_retry):
 
                 # conduct upload/download
                 if action == 'download':
-                    key.get_contents_to_filename(local_path)
+                    if sink is not None:
+                        _download_to_sink(key, local_path, sink, compression)
+                    elif compression:
+                        _download_decompressed(key, local_path)
+                    else:
+                        key.get_contents_to_filename(local_path)
                 else:
-                    key.set_contents_from_filename(local_path)
+                    if compression:
+                        _upload_compressed(key, local_path, compression)
+                    elif delta_folder:
+                        transferred = _upload_delta(key, local_path, delta_folder)
+                    else:
+                        key.set_contents_from_filename(local_path)
+
+                if transferred:
+                    queue.key_transferred()
+                else:
+                    queue.key_skipped()
 
-            elif enqueue_count > max_retry:
-                logger.error('Ignoring {0} since s3concurrent had tried downloading {1} times.'.format(key.name, max_retry))
+            else:
+                queue.key_skipped()
 
         except:
             if key.size == 0:
                 logger.info('%s is a directory, ignoring', key.name)
+                queue.key_skipped()
 
             else:
                 logger.warn('Error {0}ing file with key: {1}, putting it back to the queue'.format(action, key.name))
@@ -297,7 +1177,8 @@ def process_a_key(queue, action, max_retry):
         pass
 
 
-def consume_queue(queue, action, thread_pool_size, max_retry):
+def consume_queue(queue, action, thread_pool_size, max_retry, compression=None, sink=None, profiler=None,
+                  delta_folder=None):
     '''
     Consumes the queue with the designated thread poll size by uploading/downloading the keys to
     their respective destinations.
@@ -306,8 +1187,13 @@ def consume_queue(queue, action, thread_pool_size, max_retry):
     :param action:                  "download" or "upload"
     :param thread_pool_size:        The Designated thread pool size. (how many concurrent threads to process files.)
     :param max_retry:               The max times for s3concurrent to retry uploading/downloading a key
+    :param compression:             "gzip" or "zstd" to compress uploads and decompress downloads on the fly
+    :param sink:                    A TarSink instance to download into instead of local files
+    :param profiler:                A ThreadProfiler instance to profile the worker threads with
+    :param delta_folder:            A local folder keeping part checksums to only upload the changed parts of large files
     '''
     thread_pool = []
+    target_function = profiler.wrap(process_a_key) if profiler else process_a_key
 
     while queue.is_queuing() or not queue.is_empty() or len(thread_pool) != 0:
         # de-pool the done threads
@@ -317,14 +1203,16 @@ def consume_queue(queue, action, thread_pool_size, max_retry):
 
         # en-pool new threads
         if not queue.is_empty() and len(thread_pool) <= thread_pool_size:
-            t = threading.Thread(target=process_a_key, args=[queue, action, max_retry])
+            t = threading.Thread(target=target_function, args=[queue, action, max_retry],
+                                 kwargs={'compression': compression, 'sink': sink, 'delta_folder': delta_folder})
             t.start()
             thread_pool.append(t)
 
     queue.all_processed = True
 
 
-def process_all(action, s3_key, s3_secret, bucket_name, prefix, local_folder, queue, thread_count, max_retry):
+def process_all(action, s3_key, s3_secret, bucket_name, prefix, local_folder, queue, thread_count, max_retry,
+                from_list=None, compression=None, sink=None, profiler=None, key_filter=None, delta_folder=None):
     '''
     Orchestrates the en-queuing and consuming threads in conducting:
     1. Local folder structure construction
@@ -340,23 +1228,52 @@ def process_all(action, s3_key, s3_secret, bucket_name, prefix, local_folder, qu
     :param queue:                   A ProcessKeyQueue instance to enqueue all the keys in
     :param thread_count:            The number of threads that you wish s3concurrent to use
     :param max_retry:               The max times for s3concurrent to retry uploading/downloading a key
+    :param from_list:               An open key/file list, see open_key_list, to process instead of listing S3 or
+                                    walking the local folder
+    :param compression:             "gzip" or "zstd" to compress uploads and decompress downloads on the fly
+    :param sink:                    A TarSink instance to download into instead of local_folder
+    :param profiler:                A ThreadProfiler instance to profile the enqueuing and consuming threads with
+    :param key_filter:              A KeyFilter instance selecting the keys to process
+    :param delta_folder:            A local folder keeping part checksums to only upload the changed parts of large files
     :return:                        True is all processed, false if interrupted in any way
     '''
     conn = S3Connection(s3_key, s3_secret)
     bucket = Bucket(connection=conn, name=bucket_name)
 
+    if delta_folder and not os.path.exists(delta_folder):
+        # created once up front, worker threads would race on it
+        os.makedirs(delta_folder)
+
+    target_args = (bucket, prefix, local_folder, queue)
+    target_kwargs = {'key_filter': key_filter}
     if action == 'download':
+        target_kwargs['sink'] = sink
+
+    if from_list:
+        target_args += (read_key_list(from_list),)
+        if action == 'download':
+            target_function = enqueue_listed_keys_for_download
+        else:
+            target_function = enqueue_listed_files_for_upload
+
+    elif action == 'download':
         target_function = enqueue_s3_keys_for_download
     else:
         target_function = enqueue_s3_keys_for_upload
 
-    enqueue_thread = threading.Thread(target=target_function, args=(bucket, prefix, local_folder, queue))
+    if profiler:
+        target_function = profiler.wrap(target_function)
+
+    enqueue_thread = threading.Thread(target=target_function, args=target_args, kwargs=target_kwargs)
     enqueue_thread.daemon = True
     enqueue_thread.start()
 
     queue.queuing_started()
 
-    consume_thread = threading.Thread(target=consume_queue, args=(queue, action, thread_count, max_retry))
+    consume_thread = threading.Thread(target=profiler.wrap(consume_queue) if profiler else consume_queue,
+                                      args=(queue, action, thread_count, max_retry),
+                                      kwargs={'compression': compression, 'sink': sink, 'profiler': profiler,
+                                              'delta_folder': delta_folder})
     consume_thread.daemon = True
     consume_thread.start()
 
@@ -367,6 +1284,67 @@ def process_all(action, s3_key, s3_secret, bucket_name, prefix, local_folder, qu
 
     logger.info('{0} keys enqueued, and {1} keys {2}ed'.format(queue.enqueued_counter, queue.de_queue_counter, action))
 
+    if profiler:
+        # let the profiled threads merge their statistics before reporting
+        enqueue_thread.join()
+        consume_thread.join()
+        profiler.report()
+
+
+def build_summary(action, bucket_name, prefix, queue, all_processed, key_filter=None):
+    '''
+    Builds a summary of a run that can be merged with the summaries of the other shards.
+
+    :param action:                  download or upload
+    :param bucket_name:             Your S3 bucket name
+    :param prefix:                  The path to the S3 folder processed
+    :param queue:                   The ProcessKeyQueue instance used for the run
+    :param all_processed:           (bool) True if the run processed all keys without being interrupted
+    :param key_filter:              The KeyFilter instance used for the run
+    :return:                        (dict), the summary
+    '''
+    key_filter = key_filter or KeyFilter()
+
+    return {
+        'action': action,
+        'bucket_name': bucket_name,
+        'prefix': prefix,
+        'shards': ['{0}/{1}'.format(key_filter.shard_index, key_filter.shard_count)],
+        'includes': key_filter.includes,
+        'excludes': key_filter.excludes,
+        'enqueued': queue.first_enqueued_counter,
+        'transferred': queue.transferred_counter,
+        'skipped': queue.skipped_counter,
+        'failed': queue.failed_counter,
+        'filtered': key_filter.rejected_counter,
+        'all_processed': all_processed,
+    }
+
+
+def merge_summaries(summaries):
+    '''
+    Merges the summaries of several shards into an aggregate report.
+
+    :param summaries:               an iterable of summaries, see build_summary
+    :return:                        (dict), the aggregate summary
+    '''
+    merged = None
+
+    for summary in summaries:
+        if merged is None:
+            merged = dict(summary, shards=list(summary['shards']))
+            continue
+
+        merged['shards'] += summary['shards']
+        for counter in ['enqueued', 'transferred', 'skipped', 'failed', 'filtered']:
+            merged[counter] += summary[counter]
+        merged['all_processed'] = merged['all_processed'] and summary['all_processed']
+
+    if merged is not None:
+        merged['shards'].sort()
+
+    return merged
+
 
 def main(action, command_line_args):
     parser = argparse.ArgumentParser(prog='s3concurrent_{0}'.format(action))
@@ -377,19 +1355,88 @@ def main(action, command_line_args):
     parser.add_argument('--local_folder', default='.', help="Path to a a local filesystem folder (e.g. /my/src/folder)".format(action))
     parser.add_argument('--thread_count', default=10, help="Number of concurrent files to upload/download")
     parser.add_argument('--max_retry', default=10, help="Max retries for uploading/downloading a file")
+    parser.add_argument('--from_list', default=None, help="Path to a newline or JSON delimited list of keys/files to {0} instead of listing everything, or - for stdin".format(action))
+    parser.add_argument('--compression', default=None, choices=['gzip', 'zstd'], help="Compress uploads and decompress downloads on the fly")
+    parser.add_argument('--profile', default=None, help="Profile all threads, write the merged pstats to this path and log the top hotspots")
+    parser.add_argument('--shard', default=None, help="Only process shard i of N (e.g. 0/4), keys are assigned by a hash of their name")
+    parser.add_argument('--include', action='append', default=[], help="Only process keys matching this glob pattern, relative to the prefix/folder. Can be repeated")
+    parser.add_argument('--exclude', action='append', default=[], help="Skip keys matching this glob pattern, relative to the prefix/folder. Can be repeated")
+    parser.add_argument('--summary', default=None, help="Write a JSON summary of the run to this path, mergeable across shards")
+
+    if action == 'upload':
+        parser.add_argument('--delta_folder', default=None, help="Only upload the changed parts of large files, keeping their part checksums in this local folder")
+
+    if action == 'download':
+        parser.add_argument('--sink', default=None, help="Stream downloads into a single archive instead of local files (tar:- for stdout, or tar:<path>)")
 
     args = parser.parse_args(command_line_args)
 
+    if args.compression == 'zstd' and zstandard is None:
+        parser.error('zstd compression requires the zstandard package')
+
+    delta_folder = getattr(args, 'delta_folder', None)
+    if delta_folder and args.compression:
+        parser.error('--delta_folder cannot be combined with --compression')
+
+    list_file = None
+    if args.from_list:
+        try:
+            list_file = open_key_list(args.from_list)
+        except IOError as e:
+            parser.error('cannot read --from_list {0}: {1}'.format(args.from_list, e.strerror))
+
+    sink = None
+    if getattr(args, 'sink', None):
+        try:
+            sink = open_sink(args.sink)
+        except ValueError as e:
+            parser.error(str(e))
+
+        if sink.fileobj is sys.stdout:
+            # keep stdout clean for the archive
+            ch.stream = sys.stderr
+
+    profiler = ThreadProfiler(args.profile) if args.profile else None
+
+    shard_index, shard_count = 0, 1
+    if args.shard:
+        try:
+            shard_index, shard_count = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
+    key_filter = KeyFilter(shard_index, shard_count, args.include, args.exclude)
+
     queue = ProcessKeyQueue()
 
     if args.s3_key and args.s3_secret and args.bucket_name:
-        process_all(action, args.s3_key, args.s3_secret, args.bucket_name, args.prefix, args.local_folder, queue, int(args.thread_count), int(args.max_retry))
+        try:
+            process_all(action, args.s3_key, args.s3_secret, args.bucket_name, args.prefix, args.local_folder, queue, int(args.thread_count), int(args.max_retry),
+                        from_list=list_file, compression=args.compression, sink=sink, profiler=profiler,
+                        key_filter=key_filter, delta_folder=delta_folder)
+        finally:
+            if sink is not None:
+                sink.close()
+            if list_file not in (None, sys.stdin):
+                list_file.close()
+
+        if sink is not None and sink.failed:
+            logger.error('{0} is incomplete since some keys could not be written into it'.format(sink.target))
+            all_processed = False
+        else:
+            all_processed = queue.all_processed and not queue.enqueue_failed
 
-        if queue.all_processed:
+        if all_processed:
             logger.info('All keys are {0}ed'.format(action))
         else:
             logger.info('{0} interrupted'.format(action))
 
+        if args.summary:
+            with open(args.summary, 'w') as summary_file:
+                json.dump(build_summary(action, args.bucket_name, args.prefix, queue, all_processed, key_filter), summary_file)
+
+        return all_processed
+
     return queue.all_processed
 
 
@@ -1,12 +1,17 @@
 #!/usr/bin/env python
 
+import json
 import mock
 import os
+import pstats
 import shutil
+import tarfile
 import tempfile
+import threading
 import time
 import unittest
 import uuid
+import zlib
 
 from s3concurrent import s3concurrent
 
@@ -80,6 +85,248 @@ class TestS3Concurrent(unittest.TestCase):
 
         self.assertFalse(queue.is_queuing())
 
+    def test_read_key_list(self):
+        list_path = sandbox + 'keys.txt'
+        with open(list_path, 'wb') as f:
+            f.write('a/b/c\n')
+            f.write('\n')
+            f.write('{"key": "b/c/d", "size": 11, "etag": "\\"de3a2ccff42d63dc60c6955634d122da\\""}\n')
+            f.write('{"size": 11}\n')
+            f.write('c/d/e\r\n')
+
+        with open(list_path, 'r') as list_file:
+            entries = list(s3concurrent.read_key_list(list_file))
+
+        self.assertEquals([
+            ('a/b/c', None, None),
+            ('b/c/d', 11, '"de3a2ccff42d63dc60c6955634d122da"'),
+            ('c/d/e', None, None),
+        ], entries)
+
+    def test_enqueue_listed_keys_for_download(self):
+        listed_keys = iter([('test/prefix/a/b/c', 11, '"etag"'), ('test/prefix/b/c/d', None, None)])
+
+        queue = s3concurrent.ProcessKeyQueue()
+
+        s3concurrent.enqueue_listed_keys_for_download(mock.Mock(), 'test/prefix', sandbox, queue, listed_keys)
+
+        self.assertTrue(os.path.exists(sandbox + 'a/b/'))
+        self.assertTrue(os.path.exists(sandbox + 'b/c/'))
+
+        self.assertEquals(queue.enqueued_counter, 2)
+        key, local_path, enqueue_count = queue.de_queue_an_item()
+        self.assertEquals('test/prefix/a/b/c', key.name)
+        self.assertEquals(11, key.size)
+        self.assertEquals('"etag"', key.etag)
+        self.assertEquals(sandbox + '/a/b/c', local_path)
+
+        self.assertFalse(queue.is_queuing())
+
+    def test_enqueue_listed_files_for_upload(self):
+        for item in ['a', 'b', 'c']:
+            with open(sandbox + '{0}.txt'.format(item), 'wb') as f:
+                f.write('mocked file')
+
+        listed_files = iter([('a.txt', None, None), (sandbox + 'c.txt', None, None)])
+
+        queue = s3concurrent.ProcessKeyQueue()
+
+        s3concurrent.enqueue_listed_files_for_upload(mock.Mock(), 'test/prefix', sandbox, queue, listed_files)
+
+        self.assertEquals(queue.enqueued_counter, 2)
+        key, local_path, enqueue_count = queue.de_queue_an_item()
+        self.assertEquals('test/prefix/a.txt', key.name)
+        self.assertEquals(os.path.abspath(sandbox + 'a.txt'), local_path)
+        key, local_path, enqueue_count = queue.de_queue_an_item()
+        self.assertEquals('test/prefix/c.txt', key.name)
+
+        self.assertFalse(queue.is_queuing())
+
+    def test_enqueue_s3_keys_for_download_filtered(self):
+        mocked_keys = []
+        for name in ['a/b/c.json', 'a/b/c.txt', 'a/tmp/d.json']:
+            mocked_key = mock.Mock()
+            mocked_key.name = 'test/prefix/' + name
+            mocked_keys.append(mocked_key)
+
+        mocked_bucket = mock.Mock()
+        mocked_bucket.list = lambda prefix: mocked_keys
+
+        key_filter = s3concurrent.KeyFilter(includes=['*.json'], excludes=['a/tmp/*'])
+        queue = s3concurrent.ProcessKeyQueue()
+
+        s3concurrent.enqueue_s3_keys_for_download(mocked_bucket, 'test/prefix', sandbox, queue, key_filter=key_filter)
+
+        self.assertEquals(queue.enqueued_counter, 1)
+        self.assertEquals(key_filter.rejected_counter, 2)
+        self.assertFalse(os.path.exists(sandbox + 'a/tmp/'))
+        key, local_path, enqueue_count = queue.de_queue_an_item()
+        self.assertEquals('test/prefix/a/b/c.json', key.name)
+
+    def test_enqueue_s3_keys_for_upload_sharded(self):
+        for item in range(20):
+            with open(sandbox + '{0}.txt'.format(item), 'wb') as f:
+                f.write('mocked file')
+
+        enqueued_names = []
+        for shard_index in range(3):
+            queue = s3concurrent.ProcessKeyQueue()
+            key_filter = s3concurrent.KeyFilter(shard_index, 3)
+
+            s3concurrent.enqueue_s3_keys_for_upload(mock.Mock(), 'test/prefix', sandbox, queue, key_filter=key_filter)
+
+            self.assertEquals(20, queue.enqueued_counter + key_filter.rejected_counter)
+            while not queue.is_empty():
+                key, local_path, enqueue_count = queue.de_queue_an_item()
+                self.assertEquals(shard_index, s3concurrent.get_shard(key.name, 3))
+                enqueued_names.append(key.name)
+
+        self.assertEquals(sorted('test/prefix/{0}.txt'.format(item) for item in range(20)), sorted(enqueued_names))
+
+    def test_get_shard(self):
+        self.assertEquals(s3concurrent.get_shard('a/b/c', 7), s3concurrent.get_shard(u'a/b/c', 7))
+        self.assertEquals(int('cff49f359f080f71', 16) % 7, s3concurrent.get_shard('a/b/c', 7))
+
+    def test_parse_shard(self):
+        self.assertEquals((1, 4), s3concurrent.parse_shard('1/4'))
+        self.assertRaises(ValueError, s3concurrent.parse_shard, '4/4')
+        self.assertRaises(ValueError, s3concurrent.parse_shard, '1')
+
+    def test_merge_summaries(self):
+        summaries = []
+        for shard_index in [1, 0]:
+            queue = s3concurrent.ProcessKeyQueue()
+            queue.enqueue_item(mock.Mock(), sandbox)
+            # a retry is not counted as another enqueued key
+            queue.enqueue_item(mock.Mock(), sandbox, 2)
+            queue.key_transferred()
+            queue.key_skipped()
+            if shard_index == 0:
+                queue.key_failed()
+            key_filter = s3concurrent.KeyFilter(shard_index, 2, includes=['*.json'])
+            key_filter.rejected_counter = 3
+            summaries.append(s3concurrent.build_summary('download', 'bucket', 'test/prefix', queue, True, key_filter))
+
+        merged = s3concurrent.merge_summaries(summaries)
+
+        self.assertEquals(['0/2', '1/2'], merged['shards'])
+        self.assertEquals(2, merged['enqueued'])
+        self.assertEquals(2, merged['transferred'])
+        self.assertEquals(2, merged['skipped'])
+        self.assertEquals(1, merged['failed'])
+        self.assertEquals(6, merged['filtered'])
+        self.assertEquals(['*.json'], merged['includes'])
+        self.assertTrue(merged['all_processed'])
+        self.assertEquals(['1/2'], summaries[0]['shards'])
+
+        summaries[0]['all_processed'] = False
+        self.assertFalse(s3concurrent.merge_summaries(summaries)['all_processed'])
+
+    @mock.patch('s3concurrent.s3concurrent.process_all')
+    def test_main_failed_sink_summary(self, mocked_process_all):
+        def mocked_process(*args, **kwargs):
+            queue = args[6]
+            queue.all_processed = True
+            kwargs['sink'].failed = True
+
+        mocked_process_all.side_effect = mocked_process
+        summary_path = sandbox + 'summary.json'
+
+        s3concurrent.main('download', [
+            'key', 'secret', 'bucket', '--sink', 'tar:' + sandbox + 'out.tar', '--summary', summary_path
+        ])
+
+        with open(summary_path, 'r') as summary_file:
+            self.assertFalse(json.load(summary_file)['all_processed'])
+
+    def test_enqueue_listed_keys_for_download_error(self):
+        def listed_keys():
+            yield 'test/prefix/a/b/c', None, None
+            raise IOError
+
+        queue = s3concurrent.ProcessKeyQueue()
+        queue.queuing_started()
+
+        self.assertRaises(
+            IOError,
+            s3concurrent.enqueue_listed_keys_for_download, mock.Mock(), 'test/prefix', sandbox, queue, listed_keys()
+        )
+
+        self.assertEquals(queue.enqueued_counter, 1)
+        self.assertFalse(queue.is_queuing())
+        self.assertTrue(queue.enqueue_failed)
+
+    def test_enqueue_listed_keys_for_download_outside_prefix(self):
+        destination_folder = sandbox + 'dest'
+        listed_keys = iter([
+            ('data/a/b', None, None),
+            ('other/x', None, None),
+            ('mydata/y', None, None),
+            ('data/../../escape', None, None),
+        ])
+
+        queue = s3concurrent.ProcessKeyQueue()
+
+        s3concurrent.enqueue_listed_keys_for_download(mock.Mock(), 'data', destination_folder, queue, listed_keys)
+
+        self.assertEquals(queue.enqueued_counter, 1)
+        key, local_path, enqueue_count = queue.de_queue_an_item()
+        self.assertEquals(destination_folder + '/a/b', local_path)
+        self.assertEquals(['dest'], os.listdir(sandbox))
+
+    @mock.patch('time.sleep')
+    @mock.patch('s3concurrent.s3concurrent.S3Connection')
+    @mock.patch('s3concurrent.s3concurrent.read_key_list')
+    def test_main_from_list_error(self, mocked_read_key_list, mocked_connection, mocked_sleep):
+        def listed_keys(list_file):
+            yield 'test/prefix/a/b/c', None, None
+            raise IOError
+
+        mocked_read_key_list.side_effect = listed_keys
+        list_path = sandbox + 'keys.txt'
+        summary_path = sandbox + 'summary.json'
+        open(list_path, 'wb').close()
+
+        with mock.patch('s3concurrent.s3concurrent.process_a_key') as mocked_process_a_key:
+            mocked_process_a_key.side_effect = lambda queue, *args, **kwargs: queue.de_queue_an_item()
+
+            self.assertFalse(s3concurrent.main('download', [
+                'key', 'secret', 'bucket', '--prefix', 'test/prefix', '--local_folder', sandbox,
+                '--from_list', list_path, '--summary', summary_path
+            ]))
+
+        with open(summary_path, 'r') as summary_file:
+            self.assertFalse(json.load(summary_file)['all_processed'])
+
+    def test_enqueue_listed_files_for_upload_skipped(self):
+        os.makedirs(sandbox + 'from')
+        with open(sandbox + 'from/a.txt', 'wb') as f:
+            f.write('mocked file')
+        with open(sandbox + 'outside.txt', 'wb') as f:
+            f.write('mocked file')
+
+        listed_files = iter([
+            ('a.txt', None, None),
+            ('deleted.txt', None, None),
+            ('../outside.txt', None, None),
+            (sandbox + 'outside.txt', None, None),
+            ('/etc/hostname', None, None),
+        ])
+
+        queue = s3concurrent.ProcessKeyQueue()
+
+        s3concurrent.enqueue_listed_files_for_upload(mock.Mock(), 'p', sandbox + 'from', queue, listed_files)
+
+        self.assertEquals(queue.enqueued_counter, 1)
+        key, local_path, enqueue_count = queue.de_queue_an_item()
+        self.assertEquals('p/a.txt', key.name)
+
+    def test_main_from_list_missing(self):
+        self.assertRaises(
+            SystemExit,
+            s3concurrent.main, 'download', ['key', 'secret', 'bucket', '--from_list', sandbox + 'missing.txt']
+        )
+
     def test_download_a_key(self):
         mock_folder1 = 'a/b/'
         mocked_key1 = mock.Mock()
@@ -96,6 +343,7 @@ class TestS3Concurrent(unittest.TestCase):
         self.assertEquals(queue.de_queue_counter, 1)
         self.assertTrue(queue.is_empty())
         mocked_key1.get_contents_to_filename.assert_called_once_with(sandbox)
+        self.assertEquals(1, queue.transferred_counter)
 
     def test_download_a_key_error(self):
         mock_folder1 = 'a/b/'
@@ -159,6 +407,210 @@ class TestS3Concurrent(unittest.TestCase):
 
         self.assertEquals(queue.enqueued_counter, 2)
 
+    def test_upload_a_key_compressed(self):
+        test_key_name = sandbox + 'test.txt'
+
+        with open(test_key_name, 'wb') as f:
+            f.write('mocked file')
+
+        mocked_key1 = mock.Mock()
+        mocked_key1.name = test_key_name
+        mocked_key1.exists.return_value = False
+
+        queue = s3concurrent.ProcessKeyQueue()
+        queue.enqueue_item(mocked_key1, test_key_name)
+
+        s3concurrent.process_a_key(queue, 'upload', 1, compression='gzip')
+
+        self.assertEquals(0, mocked_key1.set_contents_from_filename.call_count)
+        mocked_key1.update_metadata.assert_called_once_with({
+            s3concurrent.ORIGINAL_MD5_METADATA: 'de3a2ccff42d63dc60c6955634d122da',
+            s3concurrent.ORIGINAL_SIZE_METADATA: '11',
+        })
+
+        args, kwargs = mocked_key1.set_contents_from_string.call_args
+        self.assertEquals({'Content-Encoding': 'gzip'}, kwargs['headers'])
+        self.assertEquals('mocked file', zlib.decompress(args[0], s3concurrent.GZIP_WBITS))
+
+    @mock.patch('s3concurrent.s3concurrent.AWS_UPLOAD_PART_SIZE', 1)
+    def test_upload_a_key_compressed_multipart(self):
+        test_key_name = sandbox + 'test.txt'
+
+        with open(test_key_name, 'wb') as f:
+            f.write('mocked file')
+
+        uploaded_parts = []
+        mocked_multipart_upload = mock.Mock()
+        mocked_multipart_upload.upload_part_from_file.side_effect = \
+            lambda fp, part_num: uploaded_parts.append((part_num, fp.read()))
+
+        mocked_key1 = mock.Mock()
+        mocked_key1.name = test_key_name
+        mocked_key1.bucket.initiate_multipart_upload.return_value = mocked_multipart_upload
+
+        s3concurrent._upload_compressed(mocked_key1, test_key_name, 'gzip')
+
+        self.assertEquals(0, mocked_key1.set_contents_from_string.call_count)
+        self.assertEquals([1, 2], [part_num for part_num, data in uploaded_parts])
+        self.assertEquals(
+            'mocked file',
+            zlib.decompress(''.join(data for part_num, data in uploaded_parts), s3concurrent.GZIP_WBITS)
+        )
+        mocked_multipart_upload.complete_upload.assert_called_once_with()
+
+    def test_download_a_key_compressed(self):
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, s3concurrent.GZIP_WBITS)
+        compressed = compressor.compress('mocked file') + compressor.flush()
+
+        mocked_key1 = mock.Mock()
+        mocked_key1.content_encoding = 'gzip'
+        mocked_key1.__iter__ = mock.Mock(return_value=iter([compressed[:5], compressed[5:]]))
+
+        s3concurrent._download_decompressed(mocked_key1, sandbox + 'a.txt')
+
+        with open(sandbox + 'a.txt', 'rb') as f:
+            self.assertEquals('mocked file', f.read())
+
+    def test_is_sync_needed_compressed(self):
+        mocked_file_path = sandbox + '/a.txt'
+
+        with open(mocked_file_path, 'wb') as f:
+            f.write('mocked file')
+
+        mocked_key1 = mock.Mock()
+        mocked_key1.bucket.get_key.return_value.get_metadata.return_value = 'de3a2ccff42d63dc60c6955634d122da'
+        self.assertFalse(s3concurrent.is_sync_needed(mocked_key1, mocked_file_path, 'gzip'))
+
+        mocked_key1.bucket.get_key.return_value.get_metadata.return_value = '032b6af31d2d1be87ff63adb423d270f'
+        self.assertTrue(s3concurrent.is_sync_needed(mocked_key1, mocked_file_path, 'gzip'))
+
+        mocked_key1.bucket.get_key.return_value = None
+        self.assertTrue(s3concurrent.is_sync_needed(mocked_key1, mocked_file_path, 'gzip'))
+
+        self.assertEquals(0, mocked_key1.exists.call_count)
+        self.assertEquals(3, mocked_key1.bucket.get_key.call_count)
+
+    def test_enqueue_s3_keys_for_download_to_sink(self):
+        mocked_key1 = mock.Mock()
+        mocked_key1.name = 'test/prefix/a/b/c'
+
+        mocked_bucket = mock.Mock()
+        mocked_bucket.list = lambda prefix: [mocked_key1]
+
+        queue = s3concurrent.ProcessKeyQueue()
+
+        s3concurrent.enqueue_s3_keys_for_download(mocked_bucket, 'test/prefix', sandbox, queue, sink=mock.Mock())
+
+        self.assertFalse(os.path.exists(sandbox + 'a'))
+        key, member_name, enqueue_count = queue.de_queue_an_item()
+        self.assertEquals('a/b/c', member_name)
+
+    def test_download_a_key_to_sink(self):
+        def mocked_get_contents_to_file(fp):
+            fp.write('mocked file')
+
+        mocked_key1 = mock.Mock()
+        mocked_key1.name = 'test/prefix/a/b/c'
+        mocked_key1.last_modified = '2015-03-04T12:00:00.000Z'
+        mocked_key1.get_contents_to_file.side_effect = mocked_get_contents_to_file
+
+        mocked_key2 = mock.Mock()
+        mocked_key2.name = 'test/prefix/a/b/'
+
+        archive_path = sandbox + 'out.tar'
+        sink = s3concurrent.open_sink('tar:' + archive_path)
+
+        queue = s3concurrent.ProcessKeyQueue()
+        queue.enqueue_item(mocked_key1, 'a/b/c')
+        queue.enqueue_item(mocked_key2, 'a/b/')
+
+        s3concurrent.process_a_key(queue, 'download', 1, sink=sink)
+        s3concurrent.process_a_key(queue, 'download', 1, sink=sink)
+        sink.close()
+
+        self.assertEquals(0, mocked_key1.exists.call_count)
+        self.assertEquals(0, mocked_key2.get_contents_to_file.call_count)
+
+        with tarfile.open(archive_path) as archive:
+            self.assertEquals(['a/b/c'], archive.getnames())
+            self.assertEquals(1425470400, archive.getmember('a/b/c').mtime)
+            self.assertEquals('mocked file', archive.extractfile('a/b/c').read())
+
+    def test_tar_sink_unicode_name(self):
+        archive_path = sandbox + 'out.tar'
+        sink = s3concurrent.TarSink(archive_path)
+        # mimic running under LANG=C
+        sink.tar.encoding = 'ascii'
+
+        spool = tempfile.SpooledTemporaryFile()
+        spool.write('mocked file')
+        spool.seek(0)
+
+        sink.add(u'a/caf\xe9.txt', spool, 11, 0)
+        sink.close()
+
+        self.assertFalse(sink.failed)
+        with tarfile.open(archive_path) as archive:
+            self.assertEquals(['a/caf\xc3\xa9.txt'], archive.getnames())
+
+    def test_tar_sink_write_error(self):
+        sink = s3concurrent.TarSink(sandbox + 'out.tar', buffer_size=2)
+        sink.tar.addfile = mock.Mock(side_effect=IOError)
+
+        fileobjs = [mock.Mock() for i in range(6)]
+
+        def add_entries():
+            for i, fileobj in enumerate(fileobjs):
+                sink.add(u'caf\xe9/{0}'.format(i), fileobj, 0, 0)
+
+        t = threading.Thread(target=add_entries)
+        t.daemon = True
+        t.start()
+        t.join(5)
+
+        # the writer keeps draining the buffer after a failure
+        self.assertFalse(t.is_alive())
+        sink.close()
+
+        self.assertTrue(sink.failed)
+        self.assertEquals(1, sink.tar.addfile.call_count)
+        for fileobj in fileobjs:
+            fileobj.close.assert_called_once_with()
+
+    def test_download_a_key_to_failed_sink(self):
+        mocked_key1 = mock.Mock()
+        mocked_key1.name = 'test/prefix/a/b/c'
+
+        sink = mock.Mock()
+        sink.failed = True
+
+        queue = s3concurrent.ProcessKeyQueue()
+        queue.enqueue_item(mocked_key1, 'a/b/c')
+
+        s3concurrent.process_a_key(queue, 'download', 1, sink=sink)
+
+        self.assertTrue(queue.is_empty())
+        self.assertEquals(0, mocked_key1.get_contents_to_file.call_count)
+        self.assertEquals(0, sink.add.call_count)
+        self.assertEquals(1, queue.failed_counter)
+
+    @mock.patch('s3concurrent.s3concurrent.process_all')
+    def test_main_failed_sink(self, mocked_process_all):
+        def mocked_process(*args, **kwargs):
+            queue = args[6]
+            queue.all_processed = True
+            kwargs['sink'].failed = True
+
+        mocked_process_all.side_effect = mocked_process
+
+        self.assertFalse(
+            s3concurrent.main('download', ['key', 'secret', 'bucket', '--sink', 'tar:' + sandbox + 'out.tar'])
+        )
+
+    def test_open_sink_unsupported(self):
+        self.assertRaises(ValueError, s3concurrent.open_sink, 'zip:' + sandbox + 'out.zip')
+        self.assertRaises(ValueError, s3concurrent.open_sink, 'tar:')
+
     def test_is_sync_needed(self):
         mocked_key1 = mock.Mock()
         mocked_key1.etag = ''
@@ -205,7 +657,7 @@ class TestS3Concurrent(unittest.TestCase):
         queue.enqueue_item(mocked_key3, sandbox)
         queue.queuing_stopped()
 
-        def mock_dequeue_a_key(queue, action, max_retry):
+        def mock_dequeue_a_key(queue, action, max_retry, **kwargs):
             queue.de_queue_an_item()
 
         mocked_consume_a_key.side_effect = mock_dequeue_a_key
@@ -233,7 +685,7 @@ class TestS3Concurrent(unittest.TestCase):
         queue.enqueue_item(mocked_key3, sandbox)
         queue.queuing_stopped()
 
-        def mock_dequeue_a_key(queue, action, max_retry):
+        def mock_dequeue_a_key(queue, action, max_retry, **kwargs):
             queue.de_queue_an_item()
 
         mocked_consume_a_key.side_effect = mock_dequeue_a_key
@@ -247,6 +699,20 @@ class TestS3Concurrent(unittest.TestCase):
         self.assertTrue(queue.is_empty())
         self.assertEquals(3, queue.de_queue_counter)
 
+    @mock.patch('s3concurrent.s3concurrent.is_sync_needed', return_value=False)
+    def test_process_a_key_skipped(self, mocked_is_sync_needed):
+        mocked_key1 = mock.Mock()
+        mocked_key1.name = 'a/b/c'
+
+        queue = s3concurrent.ProcessKeyQueue()
+        queue.enqueue_item(mocked_key1, sandbox)
+
+        s3concurrent.process_a_key(queue, 'download', 1)
+
+        self.assertEquals(0, mocked_key1.get_contents_to_filename.call_count)
+        self.assertEquals(1, queue.skipped_counter)
+        self.assertEquals(0, queue.transferred_counter)
+
     @mock.patch('time.sleep')
     @mock.patch('s3concurrent.s3concurrent.is_sync_needed', return_value=True)
     def test_process_a_key_waiting(self, mocked_is_sync_needed, mocked_sleep):
@@ -276,6 +742,173 @@ class TestS3Concurrent(unittest.TestCase):
         s3concurrent.process_a_key(queue, 'download', 1)
 
         self.assertEquals(0, mocked_sleep.call_count)
+        self.assertEquals(0, mocked_is_sync_needed.call_count)
+        self.assertEquals(1, queue.failed_counter)
+        self.assertEquals(0, queue.transferred_counter)
+
+    def test_thread_profiler(self):
+        profile_path = sandbox + 'out.pstats'
+        profiler = s3concurrent.ThreadProfiler(profile_path, top_n=5)
+
+        threads = [
+            threading.Thread(target=profiler.wrap(s3concurrent._get_md5), args=[self.temp_filename])
+            for i in range(2)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        profiler.report()
+
+        stats = pstats.Stats(profile_path)
+        md5_calls = [
+            call_count for (filename, line, function), (call_count, _, _, _, _) in stats.stats.items()
+            if function == '_get_md5'
+        ]
+        self.assertEquals([2], md5_calls)
+
+    @mock.patch('s3concurrent.s3concurrent.process_a_key')
+    def test_consume_queue_profiled(self, mocked_consume_a_key):
+        queue = s3concurrent.ProcessKeyQueue()
+        queue.enqueue_item(mock.Mock(), sandbox)
+
+        def mock_dequeue_a_key(queue, action, max_retry, **kwargs):
+            queue.de_queue_an_item()
+
+        mocked_consume_a_key.side_effect = mock_dequeue_a_key
+
+        profiler = mock.Mock()
+        profiler.wrap.side_effect = lambda target: target
+
+        s3concurrent.consume_queue(queue, 'download', 3, 1, profiler=profiler)
+
+        profiler.wrap.assert_called_once_with(mocked_consume_a_key)
+        self.assertEquals(1, queue.de_queue_counter)
+
+    @mock.patch('s3concurrent.s3concurrent.AWS_UPLOAD_PART_SIZE', 4)
+    def test_upload_delta(self):
+        test_key_name = sandbox + 'test.txt'
+        delta_folder = sandbox + 'delta/'
+
+        with open(test_key_name, 'wb') as f:
+            f.write('aaaabbbbcc')
+
+        os.makedirs(delta_folder)
+
+        uploaded_parts = []
+        mocked_multipart_upload = mock.Mock()
+        mocked_multipart_upload.upload_part_from_file.side_effect = \
+            lambda fp, part_num, md5, size: uploaded_parts.append((part_num, fp.read(size)))
+
+        mocked_key1 = mock.Mock()
+        mocked_key1.name = 'test/prefix/test.txt'
+        mocked_key1.bucket.name = 'bucket'
+        mocked_key1.bucket.initiate_multipart_upload.return_value = mocked_multipart_upload
+        mocked_key1.bucket.get_key.return_value = None
+
+        # first upload sends every part
+        self.assertTrue(s3concurrent._upload_delta(mocked_key1, test_key_name, delta_folder))
+
+        self.assertEquals([(1, 'aaaa'), (2, 'bbbb'), (3, 'cc')], uploaded_parts)
+        self.assertEquals(0, mocked_multipart_upload.copy_part_from_key.call_count)
+
+        # an unchanged file is not uploaded again
+        mocked_key1.bucket.get_key.return_value = mock.Mock()
+        mocked_key1.bucket.get_key.return_value.etag = '"{0}"'.format(
+            s3concurrent._calculate_s3_etag(test_key_name, 4))
+
+        self.assertFalse(s3concurrent._upload_delta(mocked_key1, test_key_name, delta_folder))
+        self.assertEquals(1, mocked_key1.bucket.initiate_multipart_upload.call_count)
+
+        # second upload only sends the changed and appended parts
+
+        with open(test_key_name, 'wb') as f:
+            f.write('aaaaBBBBccccd')
+
+        del uploaded_parts[:]
+        with mock.patch('s3concurrent.s3concurrent._calculate_part_md5s',
+                        wraps=s3concurrent._calculate_part_md5s) as mocked_calculate_part_md5s:
+            self.assertTrue(s3concurrent._upload_delta(mocked_key1, test_key_name, delta_folder))
+
+        # the file is hashed in a single pass
+        self.assertEquals(1, mocked_calculate_part_md5s.call_count)
+
+        self.assertEquals([(2, 'BBBB'), (3, 'cccc'), (4, 'd')], uploaded_parts)
+        mocked_multipart_upload.copy_part_from_key.assert_called_once_with(
+            'bucket', 'test/prefix/test.txt', 1, 0, 3,
+            headers={'x-amz-copy-source-if-match': mocked_key1.bucket.get_key.return_value.etag})
+        self.assertEquals(2, mocked_multipart_upload.complete_upload.call_count)
+
+    @mock.patch('s3concurrent.s3concurrent.AWS_UPLOAD_PART_SIZE', 4)
+    def test_upload_delta_remote_changed(self):
+        test_key_name = sandbox + 'test.txt'
+        delta_folder = sandbox + 'delta/'
+
+        with open(test_key_name, 'wb') as f:
+            f.write('aaaabbbbcc')
+
+        os.makedirs(delta_folder)
+
+        mocked_key1 = mock.Mock()
+        mocked_key1.name = 'test/prefix/test.txt'
+        mocked_key1.bucket.name = 'bucket'
+
+        s3concurrent._save_part_manifest(
+            mocked_key1, delta_folder, s3concurrent._calculate_part_md5s(test_key_name, 4),
+            s3concurrent._get_md5(test_key_name))
+        mocked_key1.bucket.get_key.return_value.etag = '"d41d8cd98f00b204e9800998ecf8427e-3"'
+
+        s3concurrent._upload_delta(mocked_key1, test_key_name, delta_folder)
+
+        mocked_multipart_upload = mocked_key1.bucket.initiate_multipart_upload.return_value
+        self.assertEquals(0, mocked_multipart_upload.copy_part_from_key.call_count)
+        self.assertEquals(3, mocked_multipart_upload.upload_part_from_file.call_count)
+
+    @mock.patch('s3concurrent.s3concurrent.AWS_UPLOAD_PART_SIZE', 4)
+    def test_upload_delta_single_request_upload(self):
+        test_key_name = sandbox + 'test.txt'
+        delta_folder = sandbox + 'delta/'
+
+        with open(test_key_name, 'wb') as f:
+            f.write('aaaabbbbcc')
+
+        os.makedirs(delta_folder)
+
+        # uploaded without delta mode, the etag is the plain MD5 of the file
+        mocked_key1 = mock.Mock()
+        mocked_key1.name = 'test/prefix/test.txt'
+        mocked_key1.bucket.name = 'bucket'
+        mocked_key1.bucket.get_key.return_value.etag = '"{0}"'.format(s3concurrent._get_md5(test_key_name))
+
+        self.assertFalse(s3concurrent._upload_delta(mocked_key1, test_key_name, delta_folder))
+        self.assertEquals(0, mocked_key1.bucket.initiate_multipart_upload.call_count)
+        self.assertTrue(os.path.isfile(s3concurrent._get_part_manifest_path(mocked_key1, delta_folder)))
+
+        # the saved parts are reused for the next change
+        with open(test_key_name, 'wb') as f:
+            f.write('aaaaBBBBcc')
+
+        self.assertTrue(s3concurrent._upload_delta(mocked_key1, test_key_name, delta_folder))
+
+        mocked_multipart_upload = mocked_key1.bucket.initiate_multipart_upload.return_value
+        self.assertEquals(2, mocked_multipart_upload.copy_part_from_key.call_count)
+        self.assertEquals(1, mocked_multipart_upload.upload_part_from_file.call_count)
+
+    @mock.patch('s3concurrent.s3concurrent.is_sync_needed')
+    @mock.patch('s3concurrent.s3concurrent._upload_delta', return_value=False)
+    def test_upload_a_key_delta_unchanged(self, mocked_upload_delta, mocked_is_sync_needed):
+        mocked_key1 = mock.Mock()
+        mocked_key1.name = 'a/b/c'
+
+        queue = s3concurrent.ProcessKeyQueue()
+        queue.enqueue_item(mocked_key1, sandbox)
+
+        s3concurrent.process_a_key(queue, 'upload', 1, delta_folder=sandbox + 'delta/')
+
+        mocked_upload_delta.assert_called_once_with(mocked_key1, sandbox, sandbox + 'delta/')
+        self.assertEquals(0, mocked_is_sync_needed.call_count)
+        self.assertEquals(1, queue.skipped_counter)
 
     def test_get_md5(self):
         self.assertEquals(